@@ -12,48 +12,49 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_squared_error, r2_score
-from lifelines.utils import concordance_index
+from scipy.stats import kendalltau
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import os
-import networkx as nx
+import copy
+import threading
+import multiprocessing
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from layers import *
 
 # Data Preprocessing
 def smiles_to_graph(smiles):
+    return _smiles_to_graph_cached(smiles)
+
+@functools.lru_cache(maxsize=None)
+def _smiles_to_graph_cached(smiles):
     mol = Chem.MolFromSmiles(smiles)
     if mol is None:
         return None
-    G = nx.Graph()
+    n_atoms = mol.GetNumAtoms()
+    n_bonds = mol.GetNumBonds()
     
-    node_features = []
-    for atom in mol.GetAtoms():
-        atomic_num = atom.GetAtomicNum()
-        hybridization = atom.GetHybridization()
-        chirality = atom.GetChiralTag()
-        degree = atom.GetDegree()
-        node_feature = [atomic_num, int(hybridization), int(chirality), degree]
-        node_features.append(node_feature)
-        G.add_node(atom.GetIdx(), features=node_feature)
+    node_feat = np.empty((n_atoms, 4), dtype=np.float32) # [num_nodes, num_node_features], num_node_features=4
+    for i, atom in enumerate(mol.GetAtoms()):
+        node_feat[i] = (atom.GetAtomicNum(), int(atom.GetHybridization()), int(atom.GetChiralTag()), atom.GetDegree())
     
-    edge_features = []
-    for bond in mol.GetBonds():
+    # undirected graph: each bond is stored as two directed edges
+    edge_index = np.empty((2, 2 * n_bonds), dtype=np.int64) # [2, num_edges]
+    edge_attr = np.empty((2 * n_bonds, 3), dtype=np.float32) # [num_edges, num_edge_features], num_edge_features=3
+    for i, bond in enumerate(mol.GetBonds()):
         start_idx = bond.GetBeginAtomIdx()
         end_idx = bond.GetEndAtomIdx()
-        bond_type = bond.GetBondTypeAsDouble()
-        bond_dir = bond.GetBondDir()
-        aromatic = bond.GetIsAromatic()
-        edge_feature = [bond_type, int(bond_dir), int(aromatic)]
-        edge_features.append(edge_feature)
-        G.add_edge(start_idx, end_idx)
-    
-    node_features = torch.tensor(node_features, dtype=torch.float) # [num_nodes, num_node_features], num_node_features=4
-    edge_index = torch.tensor(list(G.edges), dtype=torch.long).t().contiguous() # [2, num_nodes]
-    edge_attr = torch.tensor(edge_features, dtype=torch.float) # [num_edges, num_edge_features], num_edge_features=3
+        edge_feature = (bond.GetBondTypeAsDouble(), int(bond.GetBondDir()), int(bond.GetIsAromatic()))
+        edge_index[:, 2 * i] = (start_idx, end_idx)
+        edge_index[:, 2 * i + 1] = (end_idx, start_idx)
+        edge_attr[2 * i] = edge_feature
+        edge_attr[2 * i + 1] = edge_feature
 
-    return Data(x=node_features, edge_index=edge_index, edge_attr=edge_attr, num_nodes=len(G.nodes), num_edges=len(G.edges))
+    return Data(x=torch.from_numpy(node_feat), edge_index=torch.from_numpy(edge_index),
+                edge_attr=torch.from_numpy(edge_attr), num_nodes=n_atoms)
 
 
 class AffinityPredictionModel(nn.Module):
@@ -63,33 +64,40 @@ class AffinityPredictionModel(nn.Module):
         self.drug_encoder = GNNEncoder(input_dim=4, hidden_dim=hidden_dim, output_dim=drug_dim, edge_dim=3)
         
         # Cross Layer
-        cross_dim = max(protein_dim, drug_dim) * 3
-        self.cross_layer = CrossLayer(input_dim=cross_dim, hidden_dim=hidden_dim)
+        self.cross_layer = CrossLayer(protein_dim=protein_dim, drug_dim=drug_dim, hidden_dim=hidden_dim)
         
         # Attention Layer
         self.attention_layer = CrossAttentionLayer(protein_dim, drug_dim, attention_dim, attention_dim) # cross-attn
-        self.self_attention = SelfAttentionLayer(input_dim=drug_dim, attention_dim=attention_dim) # self-attn
         
         # Capsule Layer
-        self.protein_capsule = CapsuleLayer(input_dim=protein_dim, output_dim=capsule_dim, num_capsules=8)
-        self.drug_capsule = CapsuleLayer(input_dim=drug_dim, output_dim=capsule_dim, num_capsules=8)
+        # inputs are single pooled vectors [B, D], so dynamic routing degenerates to a linear map + squash
+        # self.protein_capsule = CapsuleLayer(input_dim=protein_dim, output_dim=capsule_dim, num_capsules=8)
+        # self.drug_capsule = CapsuleLayer(input_dim=drug_dim, output_dim=capsule_dim, num_capsules=8)
+        self.protein_capsule = nn.Sequential(nn.Linear(protein_dim, capsule_dim), Squash())
+        self.drug_capsule = nn.Sequential(nn.Linear(drug_dim, capsule_dim), Squash())
         
-        output_dim = protein_dim + drug_dim + 1 + attention_dim + attention_dim * 2
-        self.fc1 = nn.Linear(output_dim, output_dim // 2) 
-        self.fc2 = nn.Linear(output_dim // 2, output_dim // 4)
-        self.fc3 = nn.Linear(output_dim // 4, 1)
-        self.dropout = nn.Dropout(p=0.2)
+        output_dim = protein_dim + drug_dim + 1 + attention_dim + capsule_dim * 2
+        # self.fc1 = nn.Linear(output_dim, output_dim // 2) 
+        # self.fc2 = nn.Linear(output_dim // 2, output_dim // 4)
+        # self.fc3 = nn.Linear(output_dim // 4, 1)
+        self.head = nn.Sequential(
+            nn.Linear(output_dim, 512),
+            nn.ReLU(),
+            nn.Dropout(p=0.2),
+            nn.Linear(512, 128),
+            nn.ReLU(),
+            nn.Dropout(p=0.2),
+            nn.Linear(128, 1)
+        )
         # self.fc = nn.Linear(output_dim, 1)
 
-    def forward(self, protein_seq, drug_graph):
-        protein_embedding = self.protein_encoder(protein_seq)
+    def forward(self, seq_ids, drug_graph):
+        protein_embedding = self.protein_encoder(seq_ids) # cached [CLS] lookup
         
-        batch = drug_graph.batch.to(protein_embedding.device)
-        x = drug_graph.x
-        edge_index = drug_graph.edge_index
-        edge_attr = drug_graph.edge_attr
+        # drug_graph is already on device (Batch.to moves batch/ptr as well)
+        x, edge_index, edge_attr, batch, ptr = drug_graph.x, drug_graph.edge_index, drug_graph.edge_attr, drug_graph.batch, drug_graph.ptr
                
-        drug_embedding = self.drug_encoder(x, edge_index, edge_attr, drug_graph.batch)
+        drug_embedding = self.drug_encoder(x, edge_index, edge_attr, batch, ptr)
         
         # print(f"Protein embedding size: {protein_embedding.size()}")
         # print(f"Drug embedding size: {drug_embedding.size()}")
@@ -99,7 +107,6 @@ class AffinityPredictionModel(nn.Module):
             
         cross = self.cross_layer(protein_embedding, drug_embedding)
         attention_output = self.attention_layer(protein_embedding, drug_embedding) # Cross
-        self_attn = self.self_attention(drug_embedding) # Self
         # print("Attention output shape:", attention_output.shape)
         # print("Attention weight shape:", attention_weights.shape)
 
@@ -108,104 +115,204 @@ class AffinityPredictionModel(nn.Module):
         
         combined = torch.cat([protein_embedding, drug_embedding, cross, attention_output, protein_caps, drug_caps], dim=-1)
         
-        x = self.fc1(combined)
-        x = torch.relu(x)
-        x = self.dropout(x)
-        x = self.fc2(x)
-        x = torch.relu(x)
-        x = self.dropout(x)
-        x = self.fc3(x)
-        
         # return self.fc(combined).squeeze()
-        return x.squeeze()
+        return self.head(combined).squeeze(-1)
 
 # Load Dataset
-def load_dataset(file_path):
+def load_dataset(file_path, use_cache=True, num_workers=os.cpu_count()):
     data = pd.read_csv(file_path)
-    smiles_strs, graphs, sequences, affinities = [], [], [], []
-    for _, row in data.iterrows():
-        smiles_strs.append(row['iso_smiles'])
-        graph = smiles_to_graph(row['iso_smiles'])
-        if graph is None:
-            continue
-        graphs.append(graph)
-        sequences.append(row['target_sequence'])
-        affinities.append(row['affinity'])
-    return smiles_strs, graphs, sequences, torch.tensor(affinities, dtype=torch.float)
+    smiles_col = data['iso_smiles'].to_numpy()
+    seq_col = data['target_sequence'].to_numpy()
+    aff_col = data['affinity'].to_numpy(np.float32)
+    
+    # {smiles: Data} persisted next to the dataset so reruns skip RDKit
+    cache_path = os.path.splitext(file_path)[0] + "_graphs.pt"
+    graph_cache = {}
+    if use_cache and os.path.exists(cache_path):
+        graph_cache = torch.load(cache_path, weights_only=False)
+    n_cached = len(graph_cache)
+    
+    # parse each unseen SMILES once, in worker processes for large corpora
+    missing = [smi for smi in dict.fromkeys(smiles_col) if smi not in graph_cache]
+    if num_workers and num_workers > 1 and len(missing) > 256:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            parsed = executor.map(smiles_to_graph, missing, chunksize=64)
+            graph_cache.update(zip(missing, parsed))
+    else:
+        graph_cache.update((smi, smiles_to_graph(smi)) for smi in missing)
+    
+    graphs = [graph_cache[smi] for smi in smiles_col]
+    valid = np.array([graph is not None for graph in graphs], dtype=bool)
+    graphs = [graph for graph in graphs if graph is not None]
+    sequences = seq_col[valid].tolist()
+    affinities = torch.from_numpy(aff_col[valid])
+    
+    if use_cache and len(graph_cache) > n_cached:
+        torch.save(graph_cache, cache_path)
+    return smiles_col.tolist(), graphs, sequences, affinities
+
+class CustomDataset:
+    def __init__(self, graphs, sequences, affinities, seq_to_id):
+        self.graphs = graphs
+        self.seq_ids = [seq_to_id[seq] for seq in sequences]
+        self.affinities = affinities
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def __getitem__(self, idx):
+        # everything is precomputed: a cached graph, a protein embedding id and the label
+        return self.graphs[idx], self.seq_ids[idx], self.affinities[idx]
+
+def custom_collate(batch):
+    graphs = Batch.from_data_list([item[0] for item in batch])  # Combine graphs
+    seq_ids = torch.tensor([item[1] for item in batch], dtype=torch.long)
+    affinities = torch.stack([item[2] for item in batch])
+    return graphs, seq_ids, affinities
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=50, shuffle=True, drop_last=False):
+        """
+        Args:
+            lengths (list): Protein sequence length of each sample.
+            batch_size (int): Number of samples per batch.
+            bucket_size_multiplier (int): Each bucket holds batch_size * bucket_size_multiplier samples.
+            shuffle (bool): Reshuffle buckets and batches every epoch.
+            drop_last (bool): Drop the last incomplete batch of each bucket.
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        # random buckets, sorted by length inside so each batch pads to a similar length
+        indices = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for i in range(0, len(indices), self.bucket_size):
+            bucket = indices[i:i + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for j in range(0, len(bucket), self.batch_size):
+                batch = bucket[j:j + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        n_batches = 0
+        for i in range(0, len(self.lengths), self.bucket_size):
+            bucket_len = min(self.bucket_size, len(self.lengths) - i)
+            n_batches += bucket_len // self.batch_size if self.drop_last else -(-bucket_len // self.batch_size)
+        return n_batches
+
 
 # Train and Evaluate
-def train_model(model, data_loader, optimizer, criterion, device):
+def train_model(model, data_loader, optimizer, criterion, device, scaler=None, log_interval=10):
     model.train()
-    total_loss = 0
-    loss_fn = WeightedMSELoss(weight=10)
+    total_loss = torch.zeros((), device=device) # accumulated on device, synced once per epoch
+    loss_fn = WeightedMSELoss(weight=10).to(device)
+    
+    # fp16 autocast on CUDA, scaler keeps small gradients from underflowing
+    device_type = torch.device(device).type
+    use_amp = device_type == "cuda"
+    if scaler is None:
+        scaler = torch.amp.GradScaler(device_type, enabled=use_amp)
     
     with tqdm(data_loader, desc="Training", unit="batch") as pbar:
-        for batch in pbar:
-            batch = batch.to(device)
-            graphs = batch
+        for step, (graphs, seq_ids, affinities) in enumerate(pbar):
+            graphs = graphs.to(device, non_blocking=True)
             # graphs = Batch.from_data_list(graphs).to(device)
-            sequences = batch.sequences
-            affinities = batch.affinities
+            seq_ids = seq_ids.to(device, non_blocking=True)
+            affinities = affinities.to(device, non_blocking=True)
 
             optimizer.zero_grad()
-            predictions = model(sequences, graphs)
-            # loss = criterion(predictions, affinities)
-            loss = loss_fn(predictions, affinities)
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item()
+            with torch.autocast(device_type, dtype=torch.float16, enabled=use_amp):
+                predictions = model(seq_ids, graphs)
+                # loss = criterion(predictions, affinities)
+                loss = loss_fn(predictions, affinities)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            total_loss += loss.detach()
             
-            pbar.set_postfix(loss=loss.item())
+            if step % log_interval == 0:
+                pbar.set_postfix(loss=loss.item())
         
-    return total_loss / len(data_loader)
+    return total_loss.item() / len(data_loader)
 
-def evaluate_model(model, data_loader, criterion, device, return_predictions=False):
+def evaluate_model(model, data_loader, criterion, device, return_predictions=False, log_interval=10):
     model.eval()
-    total_loss = 0
-    all_preds = []
-    all_targets = []
+    total_loss = torch.zeros((), device=device)
+    preds_list = []
+    tgts_list = []
     
     with tqdm(data_loader, desc="Evaluating", unit="batch") as pbar:
-        with torch.no_grad():
-            for batch in pbar:
-                batch = batch.to(device)
-                sequences = batch.sequences
-                affinities = batch.affinities.to(device)
+        with torch.inference_mode():
+            for step, (graphs, seq_ids, affinities) in enumerate(pbar):
+                graphs = graphs.to(device, non_blocking=True)
+                seq_ids = seq_ids.to(device, non_blocking=True)
+                affinities = affinities.to(device, non_blocking=True)
                 
-                predictions = model(sequences, batch)
+                predictions = model(seq_ids, graphs)
                 loss = criterion(predictions, affinities)
-                total_loss += loss.item()
+                total_loss += loss.detach()
                 
-                all_preds.extend(predictions.cpu().numpy())
-                all_targets.extend(affinities.cpu().numpy())
+                # keep results on device, a single transfer happens after the loop
+                preds_list.append(predictions.detach().reshape(-1))
+                tgts_list.append(affinities.detach().reshape(-1))
                 
-                pbar.set_postfix(loss=loss.item())
+                if step % log_interval == 0:
+                    pbar.set_postfix(loss=loss.item())
 
-    metrics = compute_metrics(np.array(all_targets), np.array(all_preds))
-    avg_loss = total_loss / len(data_loader)
+    all_preds = torch.cat(preds_list).float().cpu().numpy()
+    all_targets = torch.cat(tgts_list).float().cpu().numpy()
+    metrics = compute_metrics(all_targets, all_preds)
+    avg_loss = total_loss.item() / len(data_loader)
     
     if return_predictions:
-        return avg_loss, metrics, np.array(all_preds), np.array(all_targets)
+        return avg_loss, metrics, all_preds, all_targets
     
     return avg_loss, metrics
 
 # Checkpoints
 
+# frozen ProtBert weights (~1.6 GB) are reloaded from the hub, no need to checkpoint them
+FROZEN_PREFIX = "protein_encoder.model."
+
+def checkpoint_state_dict(model):
+    # snapshot on CPU so the live parameters can keep training while the file is written
+    return {k: v.detach().cpu().clone() for k, v in model.state_dict().items()
+            if not (k.startswith(FROZEN_PREFIX) and model.protein_encoder.freeze_protbert)}
+
 def save_checkpoint(model, optimizer, epoch, loss, checkpoint_dir="checkpoints"):
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
     checkpoint_path = os.path.join(checkpoint_dir, f"epoch_{epoch + 1}_loss_{loss:.4f}.pt")
-    torch.save({
+    checkpoint = {
         'epoch': epoch,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
+        'model_state_dict': checkpoint_state_dict(model),
+        'optimizer_state_dict': copy.deepcopy(optimizer.state_dict()),
         'loss': loss,
-    }, checkpoint_path)
-    print(f"Checkpoint saved: {checkpoint_path}")
+    }
+    
+    # write in the background so the next epoch starts immediately, join() before exiting
+    def _save():
+        torch.save(checkpoint, checkpoint_path)
+        print(f"Checkpoint saved: {checkpoint_path}")
+    save_thread = threading.Thread(target=_save)
+    save_thread.start()
+    return save_thread
 
 def load_checkpoint(model, optimizer, checkpoint_path):
     checkpoint = torch.load(checkpoint_path)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    missing, unexpected = model.load_state_dict(checkpoint['model_state_dict'], strict=False)
+    missing = [k for k in missing if not k.startswith(FROZEN_PREFIX)]
+    if missing or unexpected:
+        raise RuntimeError(f"Checkpoint mismatch. Missing keys: {missing}, unexpected keys: {unexpected}")
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     epoch = checkpoint['epoch']
     loss = checkpoint['loss']
@@ -219,23 +326,27 @@ class EarlyStopping:
         Args:
             patience (int): Number of epochs to wait for improvement before stopping.
             verbose (bool): Print a message when training stops early.
-            checkpoint_path (str): Path to save the best model.
+            checkpoint_dir (str): Directory to save the best model in, None to skip saving.
         """
         self.patience = patience
         self.verbose = verbose
         self.best_loss = float('inf')
         self.counter = 0
         self.early_stop = False
-        self.checkpoint_path = os.path.join(checkpoint_dir, "best_model.pt")
+        self.checkpoint_path = os.path.join(checkpoint_dir, "best_model.pt") if checkpoint_dir else None
 
     def __call__(self, val_loss, model, optimizer, epoch):
         if val_loss < self.best_loss:
             self.best_loss = val_loss
             self.counter = 0
+            if self.checkpoint_path is None:
+                if self.verbose:
+                    print("Validation loss improved.")
+                return
             # Save the best model
             torch.save({
                 'epoch': epoch,
-                'model_state_dict': model.state_dict(),
+                'model_state_dict': checkpoint_state_dict(model),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'loss': val_loss,
             }, self.checkpoint_path)
@@ -251,11 +362,33 @@ class EarlyStopping:
                     print("Early stopping triggered.")
 
 
+def fast_ci(y_true, y_pred):
+    """
+    Concordance index in O(n log n), same definition as lifelines' concordance_index.
+    Pairs tied in y_true are skipped, pairs tied in y_pred count as 0.5, so
+    CI = 0.5 * (1 + (concordant - discordant) / comparable), with
+    concordant - discordant recovered from Kendall's tau-b.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+    n_pairs = len(y_true) * (len(y_true) - 1) / 2
+    _, y_ties = np.unique(y_true, return_counts=True)
+    _, p_ties = np.unique(y_pred, return_counts=True)
+    y_tied = (y_ties * (y_ties - 1) / 2).sum()
+    p_tied = (p_ties * (p_ties - 1) / 2).sum()
+    
+    comparable = n_pairs - y_tied
+    if comparable == 0 or p_tied == n_pairs:
+        return 0.5
+    tau, _ = kendalltau(y_true, y_pred)
+    con_minus_dis = tau * np.sqrt(comparable * (n_pairs - p_tied))
+    return 0.5 * (1 + con_minus_dis / comparable)
+
 def compute_metrics(y_true, y_pred):
     mse = mean_squared_error(y_true, y_pred)
     rmse = np.sqrt(mse)
     r2 = r2_score(y_true, y_pred)
-    ci = concordance_index(y_true, y_pred)
+    ci = fast_ci(y_true, y_pred)
     return {
         "MSE": mse,
         "RMSE": rmse,
@@ -280,7 +413,7 @@ def save_predictions(smiles, sequences, predictions, ground_truths, output_path)
     print(f"Predictions saved to {output_path}")
 
 def plot_affinity_scatter(predictions, ground_truths, output_file="affinity_scatter_plot.png"):
-    plt.figure(figsize=(8, 8))
+    fig = plt.figure(figsize=(8, 8))
     plt.scatter(predictions, ground_truths, alpha=0.7, edgecolor='k')
     plt.plot([min(ground_truths), max(ground_truths)],
              [min(ground_truths), max(ground_truths)], 'r--', lw=2)  # Line y=x for reference
@@ -288,16 +421,19 @@ def plot_affinity_scatter(predictions, ground_truths, output_file="affinity_scat
     plt.xlabel("Predicted Affinity", fontsize=12)
     plt.ylabel("Ground Truth Affinity", fontsize=12)
     plt.grid(True, linestyle='--', alpha=0.7)
-    plt.savefig(output_file, dpi=300, bbox_inches='tight')
+    plt.savefig(output_file, dpi=150, bbox_inches='tight')
     # plt.show()
+    plt.close(fig)
     
 class WeightedMSELoss(nn.Module):
     def __init__(self, weight=10):
         super(WeightedMSELoss, self).__init__()
         self.weight = weight
+        self.register_buffer('weight_t', torch.tensor(weight, dtype=torch.float))
 
     def forward(self, preds, targets):
-        weights = torch.where(targets > 5, self.weight, 1.0)
+        preds, targets = preds.float(), targets.float() # keep the loss in fp32 under autocast
+        weights = torch.where(targets > 5, self.weight_t, self.weight_t.new_ones(()))
         return torch.mean(weights * (preds - targets) ** 2)
 
 
@@ -326,55 +462,62 @@ if __name__ == "__main__":
     # train_data = [(graphs[i], sequences[i], affinities[i]) for i in train_idx]
     # test_data = [(graphs[i], sequences[i], affinities[i]) for i in test_idx]
     
-    class CustomDataset:
-        def __init__(self, graphs, sequences, affinities):
-            self.graphs = graphs
-            self.sequences = sequences
-            self.affinities = affinities
-
-        def __len__(self):
-            return len(self.graphs)
-
-        def __getitem__(self, idx):
-            data = self.graphs[idx]
-            data.sequences = self.sequences[idx]
-            data.affinities = self.affinities[idx]
-            return data
-
+    # Initialize model
+    model = AffinityPredictionModel(protein_dim=1024, drug_dim=256, hidden_dim=64, attention_dim=512, capsule_dim=512).to(device)
+    
+    # ProtBert embeddings are static, encode each unique target once
+    seq_to_id = model.protein_encoder.precompute_protein_embeddings(sequences_train + sequences_test)
+    
+    # compile everything downstream of the frozen ProtBert (in place, so checkpoint keys are unchanged)
+    if hasattr(nn.Module, "compile") and device.type == "cuda" and os.name != "nt":
+        model.drug_encoder.compile(dynamic=True) # node count varies per batch
+        for module in [model.cross_layer, model.attention_layer, model.protein_capsule, model.drug_capsule, model.head]:
+            module.compile()
+    
     train_data = CustomDataset([graphs_train[i] for i in train_idx],
                             [sequences_train[i] for i in train_idx],
-                            [affinities_train[i] for i in train_idx])
+                            [affinities_train[i] for i in train_idx],
+                            seq_to_id)
 
     test_data = CustomDataset([graphs_test[i] for i in test_idx],
                             [sequences_test[i] for i in test_idx],
-                            [affinities_test[i] for i in test_idx])
+                            [affinities_test[i] for i in test_idx],
+                            seq_to_id)
     
     # print(train_data[0])
+
+    # collate graphs in worker processes while the GPU trains
+    # (plain torch DataLoader: PyG's DataLoader would replace custom_collate with its own Collater)
+    num_workers = min(8, (os.cpu_count() or 2) // 2)
+    loader_kwargs = {"num_workers": num_workers, "pin_memory": device.type == "cuda"}
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
     
-    def custom_collate(batch):
-        graphs = Batch.from_data_list([item[0] for item in batch])  # Combine graphs
-        sequences = [item[1] for item in batch]  # Keep sequences as a list
-        affinities = torch.tensor([item[2] for item in batch], dtype=torch.float)
-        return graphs, sequences, affinities
-
-    train_loader = DataLoader(train_data, batch_size=32, shuffle=True, collate_fn=custom_collate)
-    test_loader = DataLoader(test_data, batch_size=32, shuffle=False, collate_fn=custom_collate)
+    if model.protein_encoder.freeze_protbert:
+        # protein embeddings are cached lookups, padding is not an issue
+        train_loader = torch.utils.data.DataLoader(train_data, batch_size=32, shuffle=True, collate_fn=custom_collate, **loader_kwargs)
+    else:
+        # ProtBert runs per batch, group similar-length sequences to cut padding
+        seq_lengths = np.array([len(s) for s in sequences_train])
+        train_loader = torch.utils.data.DataLoader(train_data, batch_sampler=BucketBatchSampler(seq_lengths, batch_size=32),
+                                                   collate_fn=custom_collate, **loader_kwargs)
+    test_loader = torch.utils.data.DataLoader(test_data, batch_size=32, shuffle=False, collate_fn=custom_collate, **loader_kwargs)
     
     # for batch in train_loader:
     #     print(batch)
     #     break
 
 
-    # Initialize model
-    model = AffinityPredictionModel(protein_dim=1024, drug_dim=256, hidden_dim=64, attention_dim=512, capsule_dim=512).to(device)
-    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=1e-3)
     criterion = nn.MSELoss()
+    scaler = torch.amp.GradScaler("cuda", enabled=device.type == "cuda")
     
     checkpoint_dir = "E:/AIDD_project/checkpoints"
     best_loss = float('inf')
     os.makedirs(checkpoint_dir, exist_ok=True)
     
-    early_stopping = EarlyStopping(patience=5, verbose=True)
+    early_stopping = EarlyStopping(patience=5, verbose=True, checkpoint_dir=None) # best model is saved below
+    save_thread = None
     
     start_epoch = -1
     
@@ -382,15 +525,19 @@ if __name__ == "__main__":
     # model, optimizer, start_epoch, _ = load_checkpoint(model, optimizer, "E:/AIDD_project/checkpoints/epoch_2_loss_0.7925.pt")
     
     log_file_path = "training_log.txt"
+    # plots are drawn off the training process; spawn, since forking a process with CUDA and live threads can deadlock
+    plot_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
 
     # Training loop
     epochs = 10 # 50
     for epoch in range(start_epoch + 1, epochs):
         print(f"Epoch {epoch + 1}/{epochs}")
-        train_loss = train_model(model, train_loader, optimizer, criterion, device)
+        train_loss = train_model(model, train_loader, optimizer, criterion, device, scaler)
         test_loss, test_metrics, predictions, ground_truths = evaluate_model(model, test_loader, criterion, device, return_predictions=True)
         
-        plot_affinity_scatter(predictions, ground_truths, f"affinity_scatter_epoch_{epoch+1}.png")
+        plotted = (epoch + 1) % 5 == 0 or epoch == epochs - 1
+        if plotted:
+            plot_executor.submit(plot_affinity_scatter, predictions, ground_truths, f"affinity_scatter_epoch_{epoch+1}.png")
         
         # Save predictions
         if epoch == epochs - 1:
@@ -410,14 +557,20 @@ if __name__ == "__main__":
         metrics = {"MSE": mse, "RMSE": rmse, "R²": r2, "CI": ci}
         log_file(epoch + 1, train_loss, test_loss, metrics, log_file_path)
         
-        save_checkpoint(model, optimizer, epoch, test_loss, checkpoint_dir)
-
-        # # best chkpt
-        # if test_loss < best_loss:
-        #     best_loss = test_loss
-        #     save_checkpoint(model, optimizer, epoch, test_loss, os.path.join(checkpoint_dir, "best_model.pt"))
+        # best chkpt only
+        if test_loss < best_loss:
+            best_loss = test_loss
+            if save_thread is not None:
+                save_thread.join()
+            save_thread = save_checkpoint(model, optimizer, epoch, test_loss, checkpoint_dir)
             
         early_stopping(test_loss, model, optimizer, epoch)
         if early_stopping.early_stop:
             print("Early stopping. Exiting training loop.")
+            if not plotted:
+                plot_executor.submit(plot_affinity_scatter, predictions, ground_truths, f"affinity_scatter_epoch_{epoch+1}.png")
             break
+    
+    if save_thread is not None:
+        save_thread.join()
+    plot_executor.shutdown(wait=True)
@@ -126,7 +126,7 @@ def evaluate_model(model, data_loader, criterion, device, return_predictions=Fal
     all_targets = []
     
     with tqdm(data_loader, desc="Evaluating", unit="batch") as pbar:
-        with torch.no_grad():
+        with torch.inference_mode():
             for batch in pbar:
                 batch = batch.to(device)
                 sequences = batch.sequences
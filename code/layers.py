@@ -12,7 +12,6 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_squared_error, r2_score
-from lifelines.utils import concordance_index
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
@@ -22,20 +21,64 @@ import matplotlib.pyplot as plt
 
 
 class ProteinEncoder(nn.Module):
-    def __init__(self, model_name="Rostlab/prot_bert", device="cuda"):
+    def __init__(self, model_name="Rostlab/prot_bert", device="cuda", freeze_protbert=True):
         super(ProteinEncoder, self).__init__()
         self.model = AutoModel.from_pretrained(model_name)
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
         self.device = device
         self.model.to(self.device)
+        
+        # ProtBert is only used as a fixed feature extractor unless fine-tuning is requested
+        self.freeze_protbert = freeze_protbert
+        if self.freeze_protbert:
+            self.model.requires_grad_(False)
+        
+        self.sequences = [] # seq_id -> sequence
+        self.embedding_dict = {} # sequence -> [CLS] embedding
+        self.cached_embeds = None
 
-    def forward(self, batch_sequences):
+    def encode(self, batch_sequences):
+        # ProtBert vocab is per residue, so residues have to be space separated
+        batch_sequences = [" ".join(seq) for seq in batch_sequences]
         tokens = self.tokenizer(batch_sequences, padding=True, truncation=True, max_length=512, return_tensors="pt")
         # tokens = {key: val.to(self.device) for key, val in tokens.items()}
         tokens = {key: val.to(next(self.model.parameters()).device) for key, val in tokens.items()}
         outputs = self.model(**tokens)
         return outputs.last_hidden_state[:, 0, :]
 
+    def precompute_protein_embeddings(self, sequences, chunk_size=32):
+        """
+        Encodes every unique sequence once and caches its [CLS] embedding.
+        Returns a dict mapping sequence -> seq_id for the dataset.
+        """
+        self.sequences = list(dict.fromkeys(sequences))
+        if self.freeze_protbert and next(self.model.parameters()).is_cuda:
+            self.model.half()
+        
+        # encode in length order so each chunk only pads to similar-length sequences
+        order = sorted(range(len(self.sequences)), key=lambda i: len(self.sequences[i]))
+        
+        was_training = self.model.training
+        self.model.eval()
+        embeds = []
+        with torch.inference_mode():
+            for i in tqdm(range(0, len(order), chunk_size), desc="Encoding proteins", unit="chunk"):
+                chunk = [self.sequences[j] for j in order[i:i + chunk_size]]
+                embeds.append(self.encode(chunk).float().cpu())
+        self.model.train(was_training)
+        
+        embeds = torch.cat(embeds, dim=0)
+        embeds = embeds[torch.argsort(torch.tensor(order))].clone() # back to seq_id order, out of inference mode
+        self.embedding_dict = {seq: emb for seq, emb in zip(self.sequences, embeds)}
+        self.cached_embeds = nn.Embedding.from_pretrained(embeds, freeze=True).to(self.device)
+        return {seq: i for i, seq in enumerate(self.sequences)}
+
+    def forward(self, seq_ids):
+        if self.freeze_protbert:
+            return self.cached_embeds(seq_ids.to(self.cached_embeds.weight.device))
+        # fine-tuning: run ProtBert on the raw sequences behind the ids
+        return self.encode([self.sequences[i] for i in seq_ids.tolist()])
+
 
 class GNNEncoder(nn.Module):
     def __init__(self, input_dim, hidden_dim, output_dim, edge_dim):
@@ -55,7 +98,7 @@ class GNNEncoder(nn.Module):
             nn.Linear(hidden_dim, output_dim)
         ), edge_dim=edge_dim)
 
-    def forward(self, x, edge_index, edge_attr, batch):
+    def forward(self, x, edge_index, edge_attr, batch, ptr=None):
         x = self.conv1(x, edge_index, edge_attr).relu()
         x = self.conv2(x, edge_index, edge_attr).relu()
         
@@ -63,28 +106,34 @@ class GNNEncoder(nn.Module):
         # batch = torch.zeros(x.size(0), dtype=torch.long, device=device)
         # print(f"Batch tensor: {batch}")
         # print(f"Batch tensor shape: {batch.shape}")
-        return global_mean_pool(x, batch)
+        if ptr is None:
+            return global_mean_pool(x, batch)
+        
+        # mean pool as one scatter-add, node counts come from the Batch ptr
+        counts = (ptr[1:] - ptr[:-1]).clamp(min=1).unsqueeze(1).to(x.dtype)
+        pooled = x.new_zeros(counts.size(0), x.size(1)).index_add_(0, batch, x)
+        return pooled / counts
         # return global_mean_pool(x, torch.zeros(x.size(0), dtype=torch.long))
 
 
 class CrossLayer(nn.Module):
-    def __init__(self, input_dim, hidden_dim):
+    def __init__(self, protein_dim, drug_dim, hidden_dim):
         super(CrossLayer, self).__init__()
-        self.fc1 = nn.Linear(input_dim, hidden_dim)
+        # project both embeddings into a shared space instead of zero-padding to max dim
+        self.p_proj = nn.Linear(protein_dim, hidden_dim)
+        self.d_proj = nn.Linear(drug_dim, hidden_dim)
+        self.fc1 = nn.Linear(hidden_dim * 3, hidden_dim)
         self.fc2 = nn.Linear(hidden_dim, hidden_dim)
         self.fc3 = nn.Linear(hidden_dim, 1)
         self.relu = nn.ReLU()
 
     def forward(self, protein_embedding, drug_embedding):
-        if protein_embedding.size(1) != drug_embedding.size(1):
-            max_dim = max(protein_embedding.size(1), drug_embedding.size(1))
-            protein_embedding = torch.cat([protein_embedding, torch.zeros(protein_embedding.size(0), max_dim - protein_embedding.size(1)).to(protein_embedding.device)], dim=-1)
-            drug_embedding = torch.cat([drug_embedding, torch.zeros(drug_embedding.size(0), max_dim - drug_embedding.size(1)).to(drug_embedding.device)], dim=-1)
+        protein_embedding = self.p_proj(protein_embedding)
+        drug_embedding = self.d_proj(drug_embedding)
         
         cross_product = protein_embedding * drug_embedding  # element-wise
         
         concatenated = torch.cat([protein_embedding, drug_embedding, cross_product], dim=-1)
-        input_dim = concatenated.size(1)
         
         x = self.fc1(concatenated)
         x = self.relu(x)
@@ -101,16 +150,14 @@ class SelfAttentionLayer(nn.Module):
         self.query_proj = nn.Linear(input_dim, attention_dim)
         self.key_proj = nn.Linear(input_dim, attention_dim)
         self.value_proj = nn.Linear(input_dim, attention_dim)
-        self.attention = nn.MultiheadAttention(embed_dim=attention_dim, num_heads=4, dropout=0.1)
 
     def forward(self, x):
-        query = self.query_proj(x).unsqueeze(0)
-        key = self.key_proj(x).unsqueeze(0)
-        value = self.value_proj(x).unsqueeze(0)
-
-        # MHA
-        attention_output, _ = self.attention(query, key, value)
-        return attention_output.squeeze(0)
+        # x is a single vector per sample (seq_len=1), softmax over one token is always 1,
+        # so attention is replaced by a learned query/key gate on the value
+        query = self.query_proj(x)
+        key = self.key_proj(x)
+        value = self.value_proj(x)
+        return torch.sigmoid(query * key) * value
     
     
 # # Cross Modality Attention
@@ -140,25 +187,53 @@ class CrossAttentionLayer(nn.Module):
         self.protein_query = nn.Linear(protein_dim, hidden_dim)
         self.drug_query = nn.Linear(drug_dim, hidden_dim)
         
-        self.attn = nn.MultiheadAttention(hidden_dim, num_heads=8)
+        # multi-head attention via F.scaled_dot_product_attention (fused/Flash kernel on CUDA)
+        self.num_heads = 8
+        self.q_proj = nn.Linear(hidden_dim, hidden_dim)
+        self.k_proj = nn.Linear(hidden_dim, hidden_dim)
+        self.v_proj = nn.Linear(hidden_dim, hidden_dim)
+        self.out_proj = nn.Linear(hidden_dim, hidden_dim)
         self.protein_output = nn.Linear(hidden_dim, protein_dim)
         self.drug_output = nn.Linear(hidden_dim, drug_dim)
         self.fusion_fc = nn.Linear(protein_dim + drug_dim, fusion_dim)
         
+    def attn(self, query, key, value):
+        # [batch_size, seq_len, hidden_dim] -> [batch_size, num_heads, seq_len, head_dim]
+        def split_heads(x):
+            return x.view(x.size(0), x.size(1), self.num_heads, -1).transpose(1, 2)
+        
+        q = split_heads(self.q_proj(query))
+        k = split_heads(self.k_proj(key))
+        v = split_heads(self.v_proj(value))
+        out = F.scaled_dot_product_attention(q, k, v)
+        out = out.transpose(1, 2).reshape(query.size(0), query.size(1), -1)
+        return self.out_proj(out)
+        
     def forward(self, protein, drug):
-        protein_query = self.protein_query(protein).unsqueeze(0)
-        drug_query = self.drug_query(drug).unsqueeze(0)
+        protein_query = self.protein_query(protein).unsqueeze(1) # (batch_size, 1, hidden_dim)
+        drug_query = self.drug_query(drug).unsqueeze(1)
 
-        protein_attention, _ = self.attn(protein_query, drug_query, drug_query)
-        drug_attention, _ = self.attn(drug_query, protein_query, protein_query)
+        protein_attention = self.attn(protein_query, drug_query, drug_query)
+        drug_attention = self.attn(drug_query, protein_query, protein_query)
 
-        fused_protein = self.protein_output(protein_attention.squeeze(0))
-        fused_drug = self.drug_output(drug_attention.squeeze(0))
+        fused_protein = self.protein_output(protein_attention.squeeze(1))
+        fused_drug = self.drug_output(drug_attention.squeeze(1))
 
         combined = torch.cat([fused_protein, fused_drug], dim=-1)
         return self.fusion_fc(combined)
 
 
+def squash(x, eps=1e-8):
+    squared_norm = (x ** 2).sum(-1, keepdim=True)
+    scale = squared_norm / (1 + squared_norm)
+    return scale * x / torch.sqrt(squared_norm + eps)
+
+
+class Squash(nn.Module):
+    def forward(self, x):
+        return squash(x)
+
+
 class CapsuleLayer(nn.Module):
     def __init__(self, input_dim, output_dim, num_capsules, routing_iterations=3):
         super(CapsuleLayer, self).__init__()
@@ -171,9 +246,7 @@ class CapsuleLayer(nn.Module):
         self.weights = nn.Parameter(torch.randn(input_dim, num_capsules, output_dim))
 
     def squash(self, x):
-        squared_norm = (x ** 2).sum(-1, keepdim=True)
-        scale = squared_norm / (1 + squared_norm)
-        return scale * x / torch.sqrt(squared_norm)
+        return squash(x)
 
     def forward(self, x):
         batch_size = x.size(0)